@@ -27,25 +27,47 @@ Examples:
 """
 
 import argparse
+import functools
 import logging
 import os
 import re
+import shutil
 import sys
+import tempfile
 import traceback
 
 from argparse import Namespace
-from io import StringIO
-from typing import List, Tuple
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator, List, Tuple, cast
 
-from git import Head, Repo, Remote
+from git import Commit, Head, Repo, Remote
 from git.exc import GitCommandError
-from pydriller import Repository
-from pydriller.domain.commit import Commit
 from setuptools_scm import Version, get_version
 
 logger = logging.getLogger("__name__")
 
-BRANCH_CHANGED = False  # Have we changed branches?
+LOG_CAPTURE_SIZE = 2000  # Log records kept for unknown error reports
+
+# Lines w/GitHub keywords (e.g. Fixes #1234) & Co-authored-by trailers
+_KEYWORDS = r'fix(es|ed)|close(s|d)|resolve(s|d)|address(es|ed)|part of'
+_KEYWORDS_RE = re.compile(
+    r'(?im)^\s*(' + _KEYWORDS + r')\s*#\d+$|^Co-authored-by.*$'
+)
+
+
+class RingBufferHandler(logging.Handler):
+    """Keep only the most recent formatted log records in a deque."""
+
+    def __init__(self, buffer: Deque[str]):
+        super().__init__()
+        self.buffer = buffer
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
 
 
 def log_setup(args):
@@ -54,7 +76,7 @@ def log_setup(args):
     global STDERR_HANDLER
     global DEBUG_HANDLER
 
-    LOG_CAPTURE = StringIO()
+    LOG_CAPTURE = deque(maxlen=LOG_CAPTURE_SIZE)
     logger.setLevel(logging.DEBUG)
 
     # INFO and below goes to stdout
@@ -71,8 +93,8 @@ def log_setup(args):
     STDERR_HANDLER.setLevel(logging.WARNING)
     logger.addHandler(STDERR_HANDLER)
 
-    # Save all logs in string object
-    DEBUG_HANDLER = logging.StreamHandler(LOG_CAPTURE)
+    # Save the most recent logs in memory
+    DEBUG_HANDLER = RingBufferHandler(LOG_CAPTURE)
     DEBUG_HANDLER.setLevel(logging.DEBUG)
     logger.addHandler(DEBUG_HANDLER)
 
@@ -106,6 +128,19 @@ def _easter_egg():
     return parser
 
 
+def positive_int(value: str) -> int:
+    """Argparse type for integers greater than zero"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"invalid positive int value: '{value}'"
+        )
+    return number
+
+
 def init_parser(parser):
     parser.add_argument(
         "release",
@@ -132,6 +167,15 @@ def init_parser(parser):
         "--allow-uncommited-changes",
         action="store_true",
         help="Allow farm to run with uncommited changes"),
+    parser.add_argument(
+        "--no-fetch",
+        action="store_true",
+        help="Branch off the last fetched default branch without fetching")
+    parser.add_argument(
+        "--max-commits",
+        type=positive_int,
+        metavar="N",
+        help="Only include the N most recent unreleased commits")
     return parser
 
 
@@ -157,6 +201,11 @@ class UntrackedFilesError(FarmError):
         super().__init__("fatal: untracked files")
 
 
+class PushError(FarmError):
+    def __init__(self, branch: str, e: GitCommandError):
+        super().__init__(f"fatal: failed to push {branch}{e.stderr}")
+
+
 def error(*args, **kwargs):
     """Drop in replacement for print that prints to stderr."""
     kwargs['file'] = sys.stderr
@@ -166,7 +215,7 @@ def error(*args, **kwargs):
 
 def unknown_error(e):
     """Dump all logs and traceback to stderr."""
-    error(LOG_CAPTURE.getvalue(), end='')
+    error(''.join(f"{line}\n" for line in LOG_CAPTURE), end='')
     error(traceback.format_exc())
 
 
@@ -174,40 +223,41 @@ def build_changelog_entries(version: str, commits: List[Commit]
                             ) -> Tuple[str, str]:
     """Returns release changelog markdown header & list of changes"""
     header = f"## {version}\n"
-    body = ""
-
-    for commit in commits:
-        body += f"{build_message(commit)}\n"
+    # Skip blank messages & those left empty once keywords are removed
+    entries = (build_message(c) for c in commits if c.message.strip())
+    body = "".join(f"{entry}\n" for entry in entries if entry)
 
     return header, body
 
 
 def build_message(commit: Commit) -> str:
     """Return changelog entry for a single commit"""
-    keywords = r'fix(es|ed)|close(s|d)|resolve(s|d)|address(es|ed)|part of'
-    regex = r'(?im)^\s*(' + keywords + r')\s*#\d+$|^Co-authored-by.*$'
+    # Remove lines w/GitHub Keywords, then empty lines and whitespace
+    message = _KEYWORDS_RE.sub('', cast(str, commit.message))
+    lines = (x.strip() for x in message.split('\n'))
+    lines = (x for x in lines if x)
 
-    # Convert commit message to List(str) & remove lines w/GitHub Keywords
-    commit_msg = re.sub(regex, '', commit.msg).split('\n')
-    # Remove empty lines and whitespace
-    commit_msg = [x.strip() for x in commit_msg if x.strip()]
+    try:
+        # Append '+ ' to commit title
+        title = '+ ' + next(lines)
+    except StopIteration:
+        return ''
 
-    # Append '+ ' to commit title
-    title = ['+ ' + commit_msg[0]]
     # Indent commit message by two spaces
-    description = [f'  {x}' for x in commit_msg[1:]]
+    return title + ''.join(f'\n  {x}' for x in lines)
+
 
-    return '\n'.join(title + description)
+@functools.lru_cache(maxsize=128)
+def _parse_version(version: str) -> Tuple[int, int, int]:
+    """Returns major, minor & micro numbers of a version string"""
+    parsed = Version(version)
+    return parsed.major, parsed.minor, parsed.micro
 
 
 def next_release(args: Namespace) -> Tuple[str, str]:
     """Returns next & current release version strings"""
     next_release, _ = get_version().split('.dev')
-
-    version = Version(next_release)
-    major = version.major
-    minor = version.minor
-    micro = version.micro
+    major, minor, micro = _parse_version(next_release)
 
     current_release = f"{major}.{minor}.{micro-1}"
 
@@ -225,20 +275,41 @@ def next_release(args: Namespace) -> Tuple[str, str]:
 
 def update_changelog(args: Namespace, changelog_path: str, entry: str):
     """Prepend entry to changelog_path"""
+    exists = True
     try:
+        # Only the header of the latest entry is needed
         with open(changelog_path, 'rb') as f:
-            content = f.read()
+            first_line = f.readline().rstrip(b'\r\n')
     except FileNotFoundError:
-        content = b''
+        exists = False
+        first_line = b''
         logger.warning(
             "WARNING: Creating CHANGELOG.md since it does not exist"
         )
 
-    if entry.split('\n')[0].encode('utf8') not in content:
+    if entry.split('\n', 1)[0].encode('utf8') != first_line:
+        # Stream old content after entry into a temp file, then swap it in
         # Without 'b', on Windows, \n is converted to \r\n
-        with open(changelog_path, 'wb') as f:
-            f.write(entry.encode('utf8'))
-            f.write(content)
+        tmp = tempfile.NamedTemporaryFile(
+            'wb', dir=os.path.dirname(changelog_path), delete=False
+        )
+        try:
+            with tmp:
+                tmp.write(entry.encode('utf8'))
+                if exists:
+                    with open(changelog_path, 'rb') as f:
+                        shutil.copyfileobj(f, tmp, length=1 << 20)
+            if exists:
+                shutil.copymode(changelog_path, tmp.name)
+            else:
+                # Temp files are 0600, use the mode open() would have
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp.name, 0o666 & ~umask)
+            os.replace(tmp.name, changelog_path)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
 
         logger.info("Updated CHANGELOG.md:")
         logger.info(entry)
@@ -251,14 +322,25 @@ def main(args: Namespace, repo: Repo):
     version, current_release = next_release(args)
     branch = create_release_branch(args, repo, remote, version)
 
-    # Retrieve unreleased commits
-    # BUG: The order is NOT deterministic :-(
-    unreleased_commits = list(Repository(
-        repo.working_tree_dir,
-        from_tag=current_release,
-        order='reverse',
-    ).traverse_commits())
-    del unreleased_commits[-1]
+    # Retrieve unreleased commits, newest first
+    if current_release in repo.tags:
+        rev = f"{current_release}..HEAD"
+    else:
+        logger.warning(f"Release tag {current_release} does not exist")
+        rev = "HEAD"
+    if args.max_commits is None:
+        unreleased_commits = list(repo.iter_commits(rev))
+    else:
+        # Walk one extra commit to tell whether the walk was truncated
+        unreleased_commits = list(
+            repo.iter_commits(rev, max_count=args.max_commits + 1)
+        )
+        if len(unreleased_commits) > args.max_commits:
+            del unreleased_commits[args.max_commits:]
+            logger.warning(
+                f"WARNING: Changelog is limited to the {args.max_commits} "
+                "most recent unreleased commits"
+            )
 
     # Build changelog entry
     title, body = build_changelog_entries(version, unreleased_commits)
@@ -281,21 +363,36 @@ def commit_push_changelog(args: Namespace, repo: Repo, remote: Remote,
     branch = repo.active_branch
 
     repo.index.add(path)
-    if repo.is_dirty():
+    # Only staged changes matter, so skip diffing the working tree
+    if repo.is_dirty(index=True, working_tree=False, untracked_files=False):
         repo.index.commit(f'Release {version}\n\n{body}')
         logger.info("Commited CHANGELOG.md on release branch")
     else:
         logger.warning("CHANGELOG.md has already been commited")
 
-    if repo.git.status(s=True) or not branch.tracking_branch():
-        remote.push(branch)
+    # Push & set the tracking branch with a single git push -u
+    tracking_branch = branch.tracking_branch()
+    # Upstream config may outlive its remote ref, e.g. after fetch --prune
+    if tracking_branch is not None and not tracking_branch.is_valid():
+        tracking_branch = None
+    if tracking_branch is None or (
+            tracking_branch.commit != branch.commit and
+            repo.is_ancestor(tracking_branch.commit, branch.commit)):
+        try:
+            repo.git.push('--set-upstream', args.remote, branch.name)
+        except GitCommandError as e:
+            raise PushError(branch.name, e)
         logger.info("Pushed release branch")
 
-        if not branch.tracking_branch():
-            branch.set_tracking_branch(remote.refs[branch.name])
+        if tracking_branch is None:
             logger.info(f"Tracking branch set: {remote.refs[branch.name]}")
         else:
             logger.warning("Tracking branch has already been set")
+    elif tracking_branch.commit != branch.commit:
+        logger.warning(
+            "Release branch is behind or has diverged from "
+            f"{tracking_branch.name}, not pushing"
+        )
     else:
         logger.warning("Release branch has already been pushed")
 
@@ -325,30 +422,54 @@ def print_pr_url(repo: Repo, remote: Remote, branch: Head):
 def create_release_branch(args: Namespace, repo: Repo, remote: Remote,
                           version: str) -> Head:
     """Create & checkout release branch off updated default branch"""
-    global BRANCH_CHANGED
     branch_name = f"release/{version}"
 
     # Update repo & determine origin's default branch (master/main)
-    remote.fetch()
+    if args.no_fetch or args.dry_run:
+        logger.info(f"Skipped fetching {remote.name}")
+    else:
+        remote.fetch()
     default_branch = remote.refs['HEAD'].ref.name
 
-    try:
+    if branch_name in repo.heads:
+        branch = repo.heads[branch_name]
+        logger.warning(f"Release branch {branch_name} already exists")
+    else:
         # Create release branch directly off origin's default branch
         branch = repo.create_head(branch_name, default_branch)
         logger.info(
             f"Created release branch {branch_name} from {default_branch}"
         )
-    except OSError:
-        branch = repo.branches[branch_name]
-        logger.warn(f"Release branch {branch_name} already exists")
 
     branch.checkout()
-    BRANCH_CHANGED = True
     logger.info(f"Checked out release branch: {branch_name}")
 
     return branch
 
 
+def _checked_out(repo: Repo) -> str:
+    """Return name of the checked out branch, or commit if detached"""
+    if repo.head.is_detached:
+        return repo.head.commit.hexsha
+    return repo.active_branch.name
+
+
+@contextmanager
+def _branch_guard(repo: Repo) -> Iterator[None]:
+    """Check out the original branch again on exit if it was changed"""
+    original = _checked_out(repo)
+    try:
+        yield
+    finally:
+        try:
+            if _checked_out(repo) != original:
+                repo.git.checkout(original)
+        except GitCommandError as e:
+            error(e)
+        except Exception as e:
+            unknown_error(e)
+
+
 def _main(user_args=None):
     args = init_parser(_easter_egg()).parse_args(user_args)
     log_setup(args)
@@ -364,7 +485,8 @@ def _main(user_args=None):
         if repo.untracked_files:
             raise UntrackedFilesError
 
-        main(args, repo)
+        with _branch_guard(repo):
+            main(args, repo)
     except FarmError as e:
         error(e)
         code = 1
@@ -372,14 +494,6 @@ def _main(user_args=None):
         unknown_error(e)
         code = 2
     finally:
-        try:
-            if BRANCH_CHANGED:
-                repo.git.checkout('-')
-        except GitCommandError as e:
-            error(e)
-        except Exception as e:
-            unknown_error(e)
-
         logging.shutdown()
 
     sys.exit(code)
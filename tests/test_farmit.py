@@ -1,13 +1,17 @@
 from argparse import Namespace
+from collections import deque
 import os
 import datetime
+import logging
+import stat
+import sys
 
 import farmit
 import pytest
 
 from pathlib import Path
 
-from git import Repo
+from git import Commit, Repo
 
 
 def commit(repo: Repo, path: Path, file_content: str, commit_message: str,
@@ -60,13 +64,7 @@ def repo(tmp_path, remote_url, request):
     # Try day before & after first commit to make sure commits are
     # NOT sorted by date but by chronological order of insertion
     # https://git-scm.com/docs/git-rev-list#_commit_ordering
-    #
-    # TODO: File a new bug report against PyDriller. It appears that #106
-    # should have solved this bug.
-    pytest.param(
-        (1970, 5, 28), (1970, 5, 27), "Commits dated before first commit",
-        marks=pytest.mark.xfail(reason="Due to a bug in PyDriller #93, #94")
-    ),
+    ((1970, 5, 28), (1970, 5, 27), "Commits dated before first commit"),
     ((1970, 5, 30), (1970, 5, 31), "Commits dated after first commit"),
 ])
 def test_basic(capsys, repo, date1, date2, emesg):
@@ -80,6 +78,8 @@ def test_basic(capsys, repo, date1, date2, emesg):
     assert excinfo.value.code == 0, error
     assert repo.active_branch.name == 'master'
     assert 'release/1.0.1' in repo.branches
+    assert repo.branches['release/1.0.1'].tracking_branch() == \
+        repo.remote('origin').refs['release/1.0.1']
 
     release_branch = repo.branches['release/1.0.1'].commit
     assert release_branch.message == \
@@ -124,10 +124,13 @@ def test_strip_normalize_newlines(repo):
     (' commit \r\n', '+ commit', 'Whitespace remains'),
     ('commit\nFixes #18', '+ commit', 'Fixes line remains'),
     ('commit\nCo-authored-by: tstark', '+ commit', 'Coauthors remain'),
+    ('commit\n\n* one\n * two\n', '+ commit\n  * one\n  * two',
+     'Description not indented'),
+    ('Fixes #18\n', '', 'Keyword only message not empty'),
 ])
 def test_build_message(mesg, output, error):
     commit = Namespace()
-    commit.msg = mesg
+    commit.message = mesg
 
     assert output == farmit.build_message(commit), error
 
@@ -150,3 +153,178 @@ def test_version_increase(repo, capsys):
         set([branch.name for branch in repo.branches])
     assert repo.branches['release/1.0.11'].commit.message == \
         "Release 1.0.11\n\n+ 1st commit\n"
+
+
+def test_update_changelog(tmp_path):
+    path = str(tmp_path / 'CHANGELOG.md')
+    umask = os.umask(0o022)
+    try:
+        farmit.update_changelog(None, path, '## 1.0.0\n\n+ First\n\n')
+    finally:
+        os.umask(umask)
+    if sys.platform != 'win32':
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o644, 'Umask ignored'
+
+    farmit.update_changelog(None, path, '## 1.0.1\n\n+ Second\n\n')
+    farmit.update_changelog(None, path, '## 1.0.1\n\n+ Second\n\n')
+
+    with open(path, 'rb') as f:
+        assert f.read() == b'## 1.0.1\n\n+ Second\n\n## 1.0.0\n\n+ First\n\n'
+    assert os.listdir(tmp_path) == ['CHANGELOG.md'], 'Temp file remains'
+
+
+@pytest.mark.parametrize("flag", ['--no-fetch', '--dry-run'])
+def test_no_fetch(repo, remote_url, tmp_path, capsys, flag):
+    commit(repo, 'main.py', 'foo', 'Local commit', (1970, 5, 30))
+    repo.git.push()
+
+    other = Repo.clone_from(remote_url, tmp_path / 'other')
+    commit(other, 'test.py', 'bar', 'Remote commit', (1970, 5, 31))
+    other.git.push()
+
+    excinfo = pytest.raises(SystemExit, farmit._main, ['micro', flag])
+    out, error = capsys.readouterr()
+    assert excinfo.value.code == 0, error
+
+    # Release branch is created off the stale origin/master
+    master = repo.commit('master')
+    release_branch = repo.branches['release/1.0.1'].commit
+    assert repo.remote('origin').refs['master'].commit == master, flag
+    assert master in (release_branch, *release_branch.parents), flag
+    assert 'Remote commit' not in out + release_branch.message, flag
+
+
+@pytest.mark.parametrize("max_commits, message, truncated", [
+    ('1', "Release 1.0.1\n\n+ 2nd commit\n", True),
+    ('2', "Release 1.0.1\n\n+ 2nd commit\n+ 1st commit\n", False),
+])
+def test_max_commits(repo, capsys, max_commits, message, truncated):
+    commit(repo, 'main.py', 'foo', '1st commit', (1970, 5, 30))
+    commit(repo, 'test.py', 'bar', '2nd commit', (1970, 5, 31))
+    repo.git.push()
+
+    excinfo = pytest.raises(SystemExit, farmit._main,
+                            ['micro', '--max-commits', max_commits])
+    out, error = capsys.readouterr()
+
+    assert excinfo.value.code == 0, error
+    assert repo.branches['release/1.0.1'].commit.message == message
+    assert ("most recent unreleased commits" in error) == truncated
+
+
+@pytest.mark.parametrize("max_commits", ['0', '-1', 'many'])
+def test_max_commits_invalid(repo, capsys, max_commits):
+    excinfo = pytest.raises(SystemExit, farmit._main,
+                            ['micro', '--max-commits', max_commits])
+    out, error = capsys.readouterr()
+
+    assert excinfo.value.code == 2
+    assert f"invalid positive int value: '{max_commits}'" in error
+    assert 'release/1.0.1' not in repo.branches
+
+
+def test_rerun(repo, capsys):
+    commit(repo, 'main.py', 'foo', '1st commit', (1970, 5, 30))
+    repo.git.push()
+
+    pytest.raises(SystemExit, farmit._main, ['micro'])
+    release_commit = repo.branches['release/1.0.1'].commit
+    capsys.readouterr()
+
+    excinfo = pytest.raises(SystemExit, farmit._main, ['micro'])
+    out, error = capsys.readouterr()
+
+    assert excinfo.value.code == 0, error
+    assert "Release branch release/1.0.1 already exists" in error
+    assert repo.active_branch.name == 'master'
+    assert repo.branches['release/1.0.1'].commit == release_commit
+
+
+@pytest.mark.parametrize("push_args, pushed, emesg", [
+    # Upstream config remains but its remote ref is gone
+    (['origin', '--delete', 'release/1.0.1'], True, "Remote branch deleted"),
+    # Tracking branch is set but behind the local release branch
+    (['--force', 'origin', 'master:release/1.0.1'], True,
+     "Remote branch behind"),
+    # Someone pushed a fixup on top of the remote release branch
+    (['origin', '{fixup}:refs/heads/release/1.0.1'], False,
+     "Remote branch ahead"),
+])
+def test_rerun_push(repo, capsys, push_args, pushed, emesg):
+    commit(repo, 'main.py', 'foo', '1st commit', (1970, 5, 30))
+    repo.git.push()
+
+    pytest.raises(SystemExit, farmit._main, ['micro'])
+    release_commit = repo.branches['release/1.0.1'].commit
+    fixup = Commit.create_from_tree(repo, release_commit.tree, 'Fixup',
+                                    [release_commit]).hexsha
+    repo.git.push(*[arg.format(fixup=fixup) for arg in push_args])
+    capsys.readouterr()
+
+    excinfo = pytest.raises(SystemExit, farmit._main, ['micro'])
+    out, error = capsys.readouterr()
+
+    remote_commit = release_commit.hexsha if pushed else fixup
+    assert excinfo.value.code == 0, error
+    assert repo.git.ls_remote('origin', 'release/1.0.1').split()[0] == \
+        remote_commit, emesg
+    assert repo.branches['release/1.0.1'].tracking_branch().commit.hexsha \
+        == remote_commit, emesg
+    assert ("not pushing" in error) != pushed, emesg
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="Needs a POSIX hook")
+def test_push_error(repo, remote_url, capsys):
+    hook = Path(remote_url[len('file://'):]) / 'hooks' / 'pre-receive'
+    hook.write_text("#!/bin/sh\nexit 1\n")
+    hook.chmod(0o755)
+    commit(repo, 'main.py', 'foo', '1st commit', (1970, 5, 30))
+
+    excinfo = pytest.raises(SystemExit, farmit._main, ['micro'])
+    out, error = capsys.readouterr()
+
+    assert excinfo.value.code == 1, error
+    assert "fatal: failed to push release/1.0.1" in error
+    assert "Traceback" not in error
+    assert repo.active_branch.name == 'master'
+
+
+def test_ring_buffer_handler():
+    buffer = deque(maxlen=2)
+    handler = farmit.RingBufferHandler(buffer)
+    logger = logging.getLogger('test_ring_buffer_handler')
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    try:
+        for n in range(3):
+            logger.warning(f"Message {n}")
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+
+    assert list(buffer) == ["Message 1", "Message 2"]
+
+
+def test_dry_run(repo, capsys):
+    commit(repo, 'main.py', 'foo', '1st commit', (1970, 5, 30))
+    repo.git.push()
+    master = repo.commit('master')
+
+    excinfo = pytest.raises(SystemExit, farmit._main, ['micro', '--dry-run'])
+    out, error = capsys.readouterr()
+
+    assert excinfo.value.code == 0, error
+    assert "## 1.0.1\n\n+ 1st commit\n" in out
+    assert repo.active_branch.name == 'master'
+    assert repo.branches['release/1.0.1'].commit == master
+    assert not repo.is_dirty()
+
+
+def test_build_changelog_entries():
+    commits = [Namespace(message=mesg) for mesg in
+               ['2nd commit', ' \n', 'Fixes #18\nCo-authored-by: tstark',
+                '1st commit']]
+
+    assert farmit.build_changelog_entries('1.0.1', commits) == \
+        ("## 1.0.1\n", "+ 2nd commit\n+ 1st commit\n")